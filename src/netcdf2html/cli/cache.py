@@ -0,0 +1,96 @@
+# MIT License
+#
+# Copyright (c) 2023 Niall McCarroll
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+import json
+import tempfile
+
+
+def _is_valid_entry(entry):
+    return isinstance(entry, dict) and isinstance(entry.get("values"), dict) \
+        and isinstance(entry.get("mtime_ns"), int) and isinstance(entry.get("size"), int)
+
+
+class FolderCache:
+
+    # values derived from the files in a folder, kept in a json sidecar file in that folder and
+    # invalidated whenever a file's modification time or size changes
+
+    def __init__(self, folder, filename=".nc2html_cache.json"):
+        self.path = os.path.join(folder, filename)
+        self.modified = False
+        try:
+            with open(self.path) as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            entries = {}
+        # a cache with an unexpected shape is treated as empty, and its bad entries are dropped on save
+        if not isinstance(entries, dict):
+            entries = {}
+            self.modified = True
+        self.entries = {name: entry for (name, entry) in entries.items() if _is_valid_entry(entry)}
+        if len(self.entries) != len(entries):
+            self.modified = True
+
+    def get(self, filename, stat, key):
+        entry = self.entries.get(filename)
+        if entry is None or entry["mtime_ns"] != stat.st_mtime_ns or entry["size"] != stat.st_size:
+            return None
+        return entry["values"].get(key)
+
+    def set(self, filename, stat, key, value):
+        entry = self.entries.get(filename)
+        if entry is None or entry["mtime_ns"] != stat.st_mtime_ns or entry["size"] != stat.st_size:
+            entry = {"mtime_ns": stat.st_mtime_ns, "size": stat.st_size, "values": {}}
+            self.entries[filename] = entry
+        elif key in entry["values"] and entry["values"][key] == value:
+            return
+        entry["values"][key] = value
+        self.modified = True
+
+    def prune(self, filenames):
+        # drop entries for files that are no longer in the folder
+        filenames = set(filenames)
+        for name in [name for name in self.entries if name not in filenames]:
+            del self.entries[name]
+            self.modified = True
+
+    def save(self):
+        if not self.modified:
+            return
+        # write to a temporary file and rename it over the cache, so an interrupted run cannot leave a partial file
+        tmp_path = None
+        try:
+            (fd, tmp_path) = tempfile.mkstemp(dir=os.path.dirname(self.path), suffix=".tmp")
+            with os.fdopen(fd, "w") as f:
+                json.dump(self.entries, f)
+            # mkstemp creates the file readable only by its owner, give it the usual permissions so that
+            # other users of a shared data folder can also read the cache
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(tmp_path, 0o666 & ~umask)
+            os.replace(tmp_path, self.path)
+        except OSError:
+            print("Warning - unable to write cache file " + self.path)
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        self.modified = False
@@ -21,21 +21,103 @@
 # SOFTWARE.
 
 import os
+import sys
+import io
+import gc
+import re
+import datetime
 import xarray as xr
+import dask
 import numpy as np
 import argparse
-
-import tempfile
+import functools
+import multiprocessing
+import concurrent.futures
 
 from htmlfive.html5_builder import Html5Builder
 
 from netcdf2html.fragments.utils import anti_aliasing_style
-from netcdf2html.fragments.image import save_image, save_image_falsecolour, InlineImageFragment
+from netcdf2html.fragments.image import (decimate, save_image, save_image_falsecolour, encode_data_uri,
+                                        use_single_thread, InlineImageFragment)
 from netcdf2html.fragments.table import TableFragment
+from netcdf2html.cli.cache import FolderCache
+
+# files where more than this fraction of the data variable is NaN are left out of the output
+MAX_NAN_FRACTION = 0.1
+
+# width of the images in the html, data is decimated down towards this width before it is rendered
+IMAGE_WIDTH = 500
+
+# each worker process runs a full garbage collection after this many files, so that reference cycles
+# still holding on to earlier datasets are released rather than accumulating
+GC_INTERVAL = 16
+
+_files_processed = 0
+
+
+# a YYYYMMDD, YYYY-MM-DD or YYYY_MM_DD date not embedded in a longer run of digits, matched in a
+# lookahead so that every candidate position is tried
+_FILENAME_DATE = re.compile(r"(?<!\d)(?=(\d{4})([-_]?)(\d{2})\2(\d{2})(?!\d))")
+
+
+def _timestamp_from_filename(filename):
+    # returns the first valid date found in the filename as YYYY-MM-DD, or None if there is none
+    for m in _FILENAME_DATE.finditer(filename):
+        (year, _, month, day) = m.groups()
+        try:
+            datetime.date(int(year), int(month), int(day))
+        except ValueError:
+            continue
+        return "%s-%s-%s" % (year, month, day)
+    return None
+
+
+def _first_time(ds):
+    # keep only the first time value, so that each file contributes exactly one entry when combined
+    return ds[["time"]].isel(time=slice(0, 1))
+
+
+def _process_file(item, main_variable, red_variable, green_variable, blue_variable, vmin, vmax):
+    # runs in a worker process, returns (timestamp, nan_frac, main_data_uri, rgb_data_uri)
+    # where the data uris are None if the file is rejected for having too many NaNs
+    global _files_processed
+    _files_processed += 1
+    if _files_processed % GC_INTERVAL == 0:
+        gc.collect()
+    (timestamp, path, nan_frac) = item
+    main_uri = None
+    rgb_uri = None
+    with xr.open_dataset(path, chunks={"time": 1}, decode_cf=True) as ds:
+        if main_variable:
+            slab = ds[main_variable].isel(time=0).values
+            if nan_frac is None:
+                nan_frac = float(np.isnan(slab).mean())
+            if nan_frac > MAX_NAN_FRACTION:
+                return (timestamp, nan_frac, None, None)
+            buf = io.BytesIO()
+            save_image(decimate(slab, IMAGE_WIDTH), vmin, vmax, buf)
+            main_uri = encode_data_uri(buf.getvalue())
+            # drop the full resolution slab before the false colour channels are read
+            del slab, buf
+        if red_variable and green_variable and blue_variable:
+            # compute the three lazy slabs together so that their reads can overlap, using one thread per
+            # channel rather than dask's default of one per core, as every pool worker does the same
+            (red, green, blue) = dask.compute(ds[red_variable].isel(time=0).data,
+                                              ds[green_variable].isel(time=0).data,
+                                              ds[blue_variable].isel(time=0).data,
+                                              scheduler="threads", num_workers=3)
+            buf = io.BytesIO()
+            save_image_falsecolour(decimate(red, IMAGE_WIDTH), decimate(green, IMAGE_WIDTH),
+                                   decimate(blue, IMAGE_WIDTH), buf)
+            del red, green, blue
+            rgb_uri = encode_data_uri(buf.getvalue())
+    return (timestamp, nan_frac, main_uri, rgb_uri)
+
 
 class Convert:
 
-    def __init__(self, folder, output_path, main_variable, red_variable, green_variable, blue_variable, vmin, vmax):
+    def __init__(self, folder, output_path, main_variable, red_variable, green_variable, blue_variable, vmin, vmax,
+                 derive_timestamp_from_filename=False):
         self.folder = folder
         self.output_path = output_path
         self.main_variable = main_variable
@@ -44,6 +126,7 @@ class Convert:
         self.blue_variable = blue_variable
         self.vmin = vmin
         self.vmax = vmax
+        self.derive_timestamp_from_filename = derive_timestamp_from_filename
 
     def run(self):
         builder = Html5Builder(language="en")
@@ -52,38 +135,67 @@ class Convert:
         builder.head().add_element("style").add_text(anti_aliasing_style)
 
         table = TableFragment()
-        table.add_row(["Acquired", self.main_variable + "(%.0f-%.0f K)" % (self.vmin, self.vmax),
-                       "RGB=(%s,%s,%s)" % (self.red_variable, self.green_variable, self.blue_variable)])
-        files = []
-        for filename in os.listdir(self.folder):
-            if filename.endswith(".nc"):
-                ds = xr.open_dataset(os.path.join(self.folder, filename))
-                timestamp = str(ds["time"].data[0])[:10]
-                files.append((timestamp, filename))
-        files = sorted(files, key=lambda item: item[0])
-
+        table.add_text_row(["Acquired", self.main_variable + "(%.0f-%.0f K)" % (self.vmin, self.vmax),
+                            "RGB=(%s,%s,%s)" % (self.red_variable, self.green_variable, self.blue_variable)])
+        cache = FolderCache(self.folder)
+        nan_frac_key = "nan_frac:%s" % self.main_variable
+        with os.scandir(self.folder) as it:
+            entries = {entry.name: entry for entry in it if entry.is_file() and entry.name.endswith(".nc")}
+        filenames = sorted(entries)
+        cache.prune(filenames)
+        stats = {filename: entries[filename].stat() for filename in filenames}
+
+        timestamps = {}
+        for filename in filenames:
+            timestamp = None
+            if self.derive_timestamp_from_filename:
+                timestamp = _timestamp_from_filename(filename)
+            if timestamp is None:
+                timestamp = cache.get(filename, stats[filename], "time")
+            if timestamp is not None:
+                timestamps[filename] = timestamp
+        undated = [filename for filename in filenames if filename not in timestamps]
+        if undated:
+            paths = [entries[filename].path for filename in undated]
+            with xr.open_mfdataset(paths, combine="nested", concat_dim="time", chunks={"time": 1},
+                                   parallel=True, preprocess=_first_time) as ds:
+                values = ds["time"].dt.strftime("%Y-%m-%d").values
+            for (filename, timestamp) in zip(undated, values):
+                timestamps[filename] = str(timestamp)
+                cache.set(filename, stats[filename], "time", str(timestamp))
+        files = sorted([(timestamps[filename], filename) for filename in filenames], key=lambda item: item[0])
+
+        process_file = functools.partial(_process_file, main_variable=self.main_variable,
+                                         red_variable=self.red_variable, green_variable=self.green_variable,
+                                         blue_variable=self.blue_variable, vmin=self.vmin, vmax=self.vmax)
+        items = []
         for (timestamp, filename) in files:
-            ds = xr.open_dataset(os.path.join(self.folder, filename))
-            cells = [timestamp]
-            if self.main_variable:
-                da = ds[self.main_variable]
-                count_nans = np.count_nonzero(np.isnan(da.data))
-                if count_nans / (da.shape[1] * da.shape[2]) > 0.1:
-                    continue
-                with tempfile.NamedTemporaryFile(suffix=".png") as p:
-                    save_image(da.data[0, :, :], self.vmin, self.vmax, p.name)
-                    cells.append(InlineImageFragment(p.name, alt_text=filename, w=500))
-            if self.red_variable and self.green_variable and self.blue_variable:
-                red = ds[self.red_variable].data[0, :, :]
-                green = ds[self.green_variable].data[0, :, :]
-                blue = ds[self.blue_variable].data[0, :, :]
-                with tempfile.NamedTemporaryFile(suffix=".png") as p:
-                    save_image_falsecolour(red, green, blue, p.name)
-                    cells.append(InlineImageFragment(p.name, alt_text=filename, w=500))
-            table.add_row(cells)
+            nan_frac = cache.get(filename, stats[filename], nan_frac_key) if self.main_variable else None
+            if nan_frac is not None and nan_frac > MAX_NAN_FRACTION:
+                continue
+            items.append((timestamp, entries[filename].path, nan_frac))
+
+        # files are spread across one worker process per core, so each worker renders single threaded.
+        # workers are spawned rather than forked, as open_mfdataset has already started dask's thread pool
+        # in this process and a forked worker would inherit that pool without its threads and block on it
+        with concurrent.futures.ProcessPoolExecutor(mp_context=multiprocessing.get_context("spawn"),
+                                                    initializer=use_single_thread) as executor:
+            for ((_, path, _), result) in zip(items, executor.map(process_file, items, chunksize=4)):
+                (timestamp, nan_frac, main_uri, rgb_uri) = result
+                filename = os.path.basename(path)
+                if nan_frac is not None:
+                    cache.set(filename, stats[filename], nan_frac_key, nan_frac)
+                    if nan_frac > MAX_NAN_FRACTION:
+                        continue
+                cells = [timestamp]
+                for data_uri in [main_uri, rgb_uri]:
+                    if data_uri is not None:
+                        cells.append(InlineImageFragment.from_data_uri(data_uri, alt_text=filename, w=IMAGE_WIDTH))
+                table.add_mixed_row(cells)
+        cache.save()
 
         builder.body().add_fragment(table)
-        with open(self.output_path, "w") as f:
+        with open(self.output_path, "w", encoding="utf-8", buffering=1 << 20) as f:
             f.write(builder.get_html())
 
 
@@ -100,15 +212,22 @@ def main():
                         help="the green variable for plotting false colour, organised by (time,y,x)")
     parser.add_argument("--blue-variable", default=None,
                         help="the blue variable for plotting false colour, organised by (time,y,x)")
+    parser.add_argument("--derive-timestamp-from-filename", action="store_true",
+                        help="take each file's date from its filename where possible, instead of opening the file")
 
     args = parser.parse_args()
 
     if args.data_variable is not None:
         if args.data_min is None or args.data_max is None:
             print("Error - please specify --data-min and --data-max if providing --data-variable")
+            sys.exit(1)
+        if args.data_min == args.data_max:
+            print("Error - please specify different values for --data-min and --data-max")
+            sys.exit(1)
 
     c = Convert(args.input_folder, args.output_path, args.data_variable, args.red_variable, args.green_variable,
-                args.blue_variable, args.data_min, args.data_max)
+                args.blue_variable, args.data_min, args.data_max,
+                derive_timestamp_from_filename=args.derive_timestamp_from_filename)
     c.run()
 
 if __name__ == '__main__':
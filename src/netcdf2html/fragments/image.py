@@ -21,31 +21,146 @@
 # SOFTWARE.
 
 from htmlfive.html5_builder import Html5Builder, Fragment, ElementFragment
+import os
 import base64
 from PIL import Image
 from matplotlib import cm
 import numpy as np
 from .utils import prepare_attrs
 
-def save_image(arr,vmin,vmax,path,cmap_name="coolwarm"):
-    if cmap_name == "viridis":
-        cmap_fn = cm.viridis
-    elif cmap_name == "coolwarm":
-        cmap_fn = cm.coolwarm
-    else:
+try:
+    from numba import njit, prange, set_num_threads
+except ImportError:
+    njit = None
+
+try:
+    import pyvips
+except (ImportError, OSError):
+    pyvips = None
+
+def use_single_thread():
+    # for callers that already render one image per process, so that numba and libvips
+    # do not each start a thread per core in every process
+    if njit is not None:
+        set_num_threads(1)
+    if pyvips is not None and hasattr(pyvips, "concurrency_set"):
+        pyvips.concurrency_set(1)
+
+def _build_lut(cmap_fn):
+    # uint8 RGBA lookup table, entries 0-255 cover the colour map and entry 256 holds the colour for NaNs
+    return np.uint8(255*cmap_fn(np.append(np.linspace(0,1,256),np.nan)))
+
+_LUTS = {cmap_name: _build_lut(getattr(cm, cmap_name)) for cmap_name in ("viridis", "coolwarm")}
+
+def _get_lut(cmap_name):
+    if cmap_name not in _LUTS:
         raise ValueError("Unknown colour map: "+cmap_name)
-    im = Image.fromarray(np.uint8((255*cmap_fn((arr-vmin)/(vmax-vmin)))))
-    im.save(path)
+    return _LUTS[cmap_name]
+
+if njit is not None:
+    @njit(parallel=True, cache=True)
+    def _colourmap(arr, vmin, vmax, lut, out):
+        # bins values the same way as matplotlib, (v-vmin)/(vmax-vmin) scaled by 256 and clipped to 0-255
+        scale = 256.0 / (vmax - vmin)
+        for y in prange(arr.shape[0]):
+            for x in range(arr.shape[1]):
+                v = arr[y, x]
+                if np.isnan(v):
+                    idx = 256
+                else:
+                    f = (v - vmin) * scale
+                    if f < 0:
+                        idx = 0
+                    elif f >= 255:
+                        idx = 255
+                    else:
+                        idx = int(f)
+                for c in range(4):
+                    out[y, x, c] = lut[idx, c]
+
+def _save_png(arr, mode, target):
+    # images are embedded once into the html, so favour encoding speed over size
+    if pyvips is not None:
+        arr = np.ascontiguousarray(arr)
+        (h, w, bands) = arr.shape
+        im = pyvips.Image.new_from_memory(arr.data, w, h, bands, "uchar")
+        # filter 8 is VIPS_FOREIGN_PNG_FILTER_NONE
+        if isinstance(target, (str, os.PathLike)):
+            im.pngsave(os.fspath(target), compression=1, filter=8)
+        else:
+            target.write(im.pngsave_buffer(compression=1, filter=8))
+    else:
+        im = Image.fromarray(arr,mode=mode)
+        im.save(target, format="PNG", compress_level=1, optimize=False)
+
+def decimate(arr, max_width):
+    # keep every n-th row and column, while staying at least max_width wide
+    step = max(1, arr.shape[1] // max_width)
+    return arr[::step, ::step]
+
+def save_image(arr,vmin,vmax,target,cmap_name="coolwarm"):
+    if vmin == vmax:
+        raise ValueError("vmin and vmax must be different, both are %s" % vmin)
+    if njit is not None:
+        rgba = np.empty(arr.shape+(4,),dtype=np.uint8)
+        _colourmap(arr, float(vmin), float(vmax), _get_lut(cmap_name), rgba)
+    else:
+        lut = _get_lut(cmap_name)
+        scaled = (arr-vmin)*(256.0/(vmax-vmin))
+        nans = np.isnan(scaled)
+        np.clip(scaled, 0, 255, out=scaled)
+        scaled[nans] = 256
+        rgba = np.take(lut, scaled.astype(np.intp), axis=0)
+    _save_png(rgba, "RGBA", target)
+
+if njit is not None:
+    @njit(parallel=True, cache=True)
+    def _minmax_nan(a):
+        # min and max ignoring NaNs in one pass, rows are reduced in parallel and then combined
+        rows = a.shape[0]
+        row_lo = np.full(rows, np.inf)
+        row_hi = np.full(rows, -np.inf)
+        for y in prange(rows):
+            lo = np.inf
+            hi = -np.inf
+            for x in range(a.shape[1]):
+                v = a[y, x]
+                if v < lo:
+                    lo = v
+                if v > hi:
+                    hi = v
+            row_lo[y] = lo
+            row_hi[y] = hi
+        return (row_lo.min(), row_hi.max())
+
+    @njit(parallel=True, cache=True)
+    def _fill_channel(src, out, c, lo, hi):
+        # rescale src from lo-hi to 0-255 and write it into channel c of out, NaNs and constant channels become 0
+        s = 255.0 / (hi - lo) if hi > lo else 0.0
+        for y in prange(src.shape[0]):
+            for x in range(src.shape[1]):
+                v = src[y, x]
+                if np.isnan(v):
+                    out[y, x, c] = 0
+                else:
+                    out[y, x, c] = np.uint8((v - lo) * s)
 
-def save_image_falsecolour(data_red, data_green, data_blue, path):
-    alist = []
-    for arr in [data_red, data_green, data_blue]:
-        minv = np.nanmin(arr)
-        maxv = np.nanmax(arr)
-        alist.append((255*(arr-minv) / (maxv-minv)).astype(np.uint8))
-    arr = np.stack(alist,axis=-1)
-    im = Image.fromarray(arr,mode="RGB")
-    im.save(path)
+def save_image_falsecolour(data_red, data_green, data_blue, target):
+    # write each channel straight into a C-contiguous (H,W,3) buffer, which PIL can take without copying
+    arr = np.empty(data_red.shape+(3,),dtype=np.uint8,order="C")
+    if njit is not None:
+        for (c, src) in enumerate([data_red, data_green, data_blue]):
+            (minv, maxv) = _minmax_nan(src)
+            _fill_channel(src, arr, c, minv, maxv)
+    else:
+        # a (3,H,W) stack lets the reductions and the rescale cover all channels in single calls
+        chans = np.stack([data_red, data_green, data_blue])
+        minv = np.nanmin(chans, axis=(1,2), keepdims=True)
+        maxv = np.nanmax(chans, axis=(1,2), keepdims=True)
+        spread = maxv-minv
+        scale = np.divide(255.0, spread, out=np.zeros(spread.shape), where=spread > 0)
+        np.moveaxis(arr, -1, 0)[...] = np.nan_to_num((chans-minv) * scale)
+    _save_png(arr, "RGB", target)
 
 
 class ImageFragment(ElementFragment):
@@ -55,14 +170,35 @@ class ImageFragment(ElementFragment):
             "src": src, "alt":alt_text, "width": w, "height": h}))
 
 
+def encode_data_uri(content_bytes,mime_type="image/png"):
+    return b"data:" + mime_type.encode("ascii") + b";base64," + base64.b64encode(content_bytes)
+
+
+def inlined_bytes(content_bytes,mime_type="image/png"):
+    return str(encode_data_uri(content_bytes, mime_type), "ascii")
+
+
 def inlined_image(from_path,mime_type="image/png"):
     with open(from_path,"rb") as f:
         content_bytes = f.read()
-    return "data:" + mime_type + ";charset=US-ASCII;base64," + str(base64.b64encode(content_bytes), "utf-8")
+    return inlined_bytes(content_bytes, mime_type)
 
 
 class InlineImageFragment(ElementFragment):
 
-    def __init__(self, path, alt_text="", w=None, h=None):
+    def __init__(self, path, alt_text="", w=None, h=None, src=None):
+        # src can pass in a ready made data uri, in which case path is not read
+        if src is None:
+            src = inlined_image(path)
         super().__init__("img", prepare_attrs({
-            "src": inlined_image(path), "alt":alt_text, "width": w, "height": h}))
+            "src": src, "alt":alt_text, "width": w, "height": h}))
+
+    @classmethod
+    def from_bytes(cls, content_bytes, mime_type="image/png", alt_text="", w=None, h=None):
+        # build the fragment from image data already held in memory, without a round trip through a file
+        return cls.from_data_uri(encode_data_uri(content_bytes, mime_type), alt_text=alt_text, w=w, h=h)
+
+    @classmethod
+    def from_data_uri(cls, data_uri, alt_text="", w=None, h=None):
+        # build the fragment from a data uri already encoded as ascii bytes, see encode_data_uri
+        return cls(None, alt_text=alt_text, w=w, h=h, src=str(data_uri, "ascii"))
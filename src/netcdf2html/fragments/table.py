@@ -29,9 +29,17 @@ class TableFragment(ElementFragment):
         super().__init__("table",attrs,style)
 
     def add_row(self, cells):
-        tr = self.add_element("tr")
+        self.add_mixed_row(cells)
+
+    def add_text_row(self, texts):
+        add_td = self.add_element("tr").add_element
+        for text in texts:
+            add_td("td").add_text(text)
+
+    def add_mixed_row(self, cells):
+        add_td = self.add_element("tr").add_element
         for cell in cells:
-            td = tr.add_element("td")
+            td = add_td("td")
             if isinstance(cell,str):
                 td.add_text(cell)
             else:
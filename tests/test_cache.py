@@ -0,0 +1,84 @@
+# MIT License
+#
+# Copyright (c) 2023 Niall McCarroll
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+import sys
+import json
+import stat as stat_mode
+
+import pytest
+
+from netcdf2html.cli.cache import FolderCache
+
+
+def _write(path, content):
+    with open(path, "w") as f:
+        f.write(content)
+
+
+def test_unchanged_values_do_not_rewrite_cache(tmp_path):
+    _write(tmp_path / "a.nc", "data")
+    stat = os.stat(tmp_path / "a.nc")
+    cache = FolderCache(str(tmp_path))
+    cache.set("a.nc", stat, "time", "2020-01-01")
+    cache.save()
+
+    cache = FolderCache(str(tmp_path))
+    assert cache.get("a.nc", stat, "time") == "2020-01-01"
+    cache.set("a.nc", stat, "time", "2020-01-01")
+    assert not cache.modified
+
+
+def test_prune_drops_missing_files(tmp_path):
+    _write(tmp_path / "a.nc", "data")
+    stat = os.stat(tmp_path / "a.nc")
+    cache = FolderCache(str(tmp_path))
+    cache.set("a.nc", stat, "time", "2020-01-01")
+    cache.set("b.nc", stat, "time", "2020-01-02")
+    cache.prune(["a.nc"])
+    cache.save()
+
+    with open(cache.path) as f:
+        assert list(json.load(f)) == ["a.nc"]
+
+
+def test_malformed_cache_is_treated_as_empty(tmp_path):
+    _write(tmp_path / "a.nc", "data")
+    stat = os.stat(tmp_path / "a.nc")
+    _write(tmp_path / ".nc2html_cache.json", "[1, 2, 3]")
+    assert FolderCache(str(tmp_path)).get("a.nc", stat, "time") is None
+
+    _write(tmp_path / ".nc2html_cache.json", json.dumps({"a.nc": {"mtime_ns": stat.st_mtime_ns}}))
+    assert FolderCache(str(tmp_path)).get("a.nc", stat, "time") is None
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="posix file modes")
+def test_cache_file_has_default_permissions(tmp_path):
+    _write(tmp_path / "a.nc", "data")
+    stat = os.stat(tmp_path / "a.nc")
+    cache = FolderCache(str(tmp_path))
+    cache.set("a.nc", stat, "time", "2020-01-01")
+    cache.save()
+
+    umask = os.umask(0)
+    os.umask(umask)
+    assert stat_mode.S_IMODE(os.stat(cache.path).st_mode) == 0o666 & ~umask
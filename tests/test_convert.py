@@ -0,0 +1,79 @@
+# MIT License
+#
+# Copyright (c) 2023 Niall McCarroll
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import numpy as np
+import xarray as xr
+
+from netcdf2html.cli.convert import Convert, _timestamp_from_filename
+
+
+def _write_netcdf(path, date, nan_fraction=0.0):
+    (h, w) = (20, 30)
+    rng = np.random.default_rng(0)
+    sst = 270 + 30*rng.random((1, h, w))
+    sst.reshape(-1)[:int(nan_fraction*h*w)] = np.nan
+    ds = xr.Dataset({name: (("time", "y", "x"), arr) for (name, arr) in [
+        ("sst", sst), ("red", rng.random((1, h, w))), ("green", rng.random((1, h, w))),
+        ("blue", rng.random((1, h, w)))]}, coords={"time": [np.datetime64(date, "ns")]})
+    ds.to_netcdf(path)
+
+
+def test_timestamp_from_filename_formats():
+    assert _timestamp_from_filename("sst_20200101.nc") == "2020-01-01"
+    assert _timestamp_from_filename("sst_2020-01-02.nc") == "2020-01-02"
+    assert _timestamp_from_filename("sst_2020_01_03.nc") == "2020-01-03"
+    assert _timestamp_from_filename("sst_20200104T1200.nc") == "2020-01-04"
+
+
+def test_timestamp_from_filename_skips_invalid_candidates():
+    assert _timestamp_from_filename("sst_v0123_20200101.nc") == "2020-01-01"
+    assert _timestamp_from_filename("sst_20201301_20200105.nc") == "2020-01-05"
+
+
+def test_timestamp_from_filename_no_date():
+    assert _timestamp_from_filename("run1234_0512.nc") is None
+    assert _timestamp_from_filename("sst_2020-01_02.nc") is None
+    assert _timestamp_from_filename("sst_123456789.nc") is None
+    assert _timestamp_from_filename("sst.nc") is None
+
+
+def test_run(tmp_path):
+    folder = tmp_path / "data"
+    folder.mkdir()
+    # the names carry no dates, so the files are ordered by their time coordinate
+    _write_netcdf(folder / "a.nc", "2020-01-03")
+    _write_netcdf(folder / "b.nc", "2020-01-01")
+    _write_netcdf(folder / "c.nc", "2020-01-02", nan_fraction=0.5)
+
+    # the second run is served from the sidecar cache written by the first
+    for _ in range(2):
+        output_path = tmp_path / "out.html"
+        Convert(str(folder), str(output_path), "sst", "red", "green", "blue", 270, 300).run()
+        with open(output_path, encoding="utf-8") as f:
+            html = f.read()
+
+        # a header row plus one row per file, the file with too many NaNs is left out
+        assert html.count("<tr") == 3
+        assert html.count("<img") == 4
+        assert "2020-01-02" not in html
+        assert html.index("2020-01-01") < html.index("2020-01-03")
+    assert (folder / ".nc2html_cache.json").exists()
@@ -0,0 +1,107 @@
+# MIT License
+#
+# Copyright (c) 2023 Niall McCarroll
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import io
+
+import numpy as np
+import pytest
+from PIL import Image
+from matplotlib import cm
+
+from netcdf2html.fragments import image
+
+
+@pytest.fixture(params=[(True, True), (True, False), (False, True), (False, False)],
+                ids=["numba-pyvips", "numba-pil", "numpy-pyvips", "numpy-pil"])
+def render_path(request, monkeypatch):
+    # select one of the four rendering paths, skipping those whose optional dependency is missing
+    (use_numba, use_pyvips) = request.param
+    if use_numba and image.njit is None:
+        pytest.skip("numba is not installed")
+    if use_pyvips and image.pyvips is None:
+        pytest.skip("pyvips is not installed")
+    if not use_numba:
+        monkeypatch.setattr(image, "njit", None)
+    if not use_pyvips:
+        monkeypatch.setattr(image, "pyvips", None)
+
+
+def _decode(buf):
+    return np.asarray(Image.open(io.BytesIO(buf.getvalue())))
+
+
+def test_save_image_matches_matplotlib(render_path):
+    # a span of 256 keeps the scaling exact, so every value lands in the same bin as in matplotlib
+    (vmin, vmax) = (-128.0, 128.0)
+    a = np.linspace(-200.0, 300.0, 8*64).reshape(8, 64)
+    a[0, :3] = [np.nan, np.inf, -np.inf]
+    buf = io.BytesIO()
+    image.save_image(a, vmin, vmax, buf)
+    expected = np.uint8(255*cm.coolwarm((a-vmin)/(vmax-vmin)))
+    np.testing.assert_array_equal(_decode(buf), expected)
+
+
+def test_save_image_equal_range_raises(render_path):
+    with pytest.raises(ValueError):
+        image.save_image(np.zeros((4, 4)), 1.0, 1.0, io.BytesIO())
+
+
+def _baseline_falsecolour(channels):
+    # the original float implementation, for channels without NaNs
+    return np.stack([(255*(arr-np.nanmin(arr)) / (np.nanmax(arr)-np.nanmin(arr))).astype(np.uint8)
+                     for arr in channels], axis=-1)
+
+
+def test_save_image_falsecolour_matches_baseline(render_path):
+    rng = np.random.default_rng(0)
+    channels = [rng.normal(loc, scale, (16, 24)) for (loc, scale) in [(0, 1), (300, 20), (-5, 0.01)]]
+    expected = _baseline_falsecolour(channels)
+    channels[0][3, 4] = np.nan
+    buf = io.BytesIO()
+    image.save_image_falsecolour(*channels, buf)
+    out = _decode(buf)
+    assert out.shape == (16, 24, 3)
+    assert out[3, 4, 0] == 0
+    diff = np.abs(out.astype(int) - expected.astype(int))
+    diff[3, 4, 0] = 0
+    assert diff.max() <= 1
+
+
+def test_save_image_falsecolour_degenerate_channels(render_path):
+    rng = np.random.default_rng(0)
+    red = rng.random((8, 8))
+    green = np.full((8, 8), 7.0)
+    blue = np.full((8, 8), np.nan)
+    buf = io.BytesIO()
+    image.save_image_falsecolour(red, green, blue, buf)
+    out = _decode(buf)
+    assert (out[..., 1] == 0).all()
+    assert (out[..., 2] == 0).all()
+    assert np.abs(out[..., 0].astype(int) - _baseline_falsecolour([red])[..., 0].astype(int)).max() <= 1
+
+
+def test_decimate_widths():
+    assert image.decimate(np.zeros((10, 499)), 500).shape == (10, 499)
+    assert image.decimate(np.zeros((10, 500)), 500).shape == (10, 500)
+    assert image.decimate(np.zeros((10, 1000)), 500).shape == (5, 500)
+    assert image.decimate(np.zeros((10, 1200)), 500).shape == (5, 600)
+    assert image.decimate(np.zeros((10, 1499)), 500).shape == (5, 750)